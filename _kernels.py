@@ -0,0 +1,219 @@
+"""
+Ядро индикаторов: один проход по барам обновляет сразу EMA, MACD, RSI,
+Bollinger, ATR, Stochastic и ADX.
+
+Состояние инструмента — плоский float64-массив (скаляры + кольцевые буферы),
+поэтому его можно компилировать numba, копировать и сохранять в pickle.
+Если numba не установлена, функции работают как обычный Python.
+"""
+import math
+import numpy as np
+
+try:
+    from numba import njit, types
+    JIT = True
+    # Входные бары приходят из pandas и могут быть read-only
+    _RO = types.Array(types.float64, 1, "C", readonly=True)
+    _UPDATE_SIG = types.void(types.float64[::1], _RO, _RO, _RO)
+except ImportError:  # numba опциональна
+    JIT = False
+    _UPDATE_SIG = None
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# Скалярные слоты состояния
+N, PREV_H, PREV_L, PREV_C = 0, 1, 2, 3
+CLOSE, EMA20, EMA50, EMA_F, EMA_S = 4, 5, 6, 7, 8
+MACD, MACD_SIG, MACD_HIST = 9, 10, 11
+AVG_GAIN, AVG_LOSS, RSI = 12, 13, 14
+BB_HIGH, BB_LOW = 15, 16
+TR_SUM, ATR = 17, 18
+STOCH_K, STOCH_D = 19, 20
+TR_S, PDM_S, MDM_S, DX_SUM, ADX = 21, 22, 23, 24, 25
+BB_MEAN, BB_M2 = 26, 27
+MAXQ_H, MAXQ_C, MINQ_H, MINQ_C = 28, 29, 30, 31  # голова/длина монотонных очередей
+
+# Параметры (пишутся в состояние при создании)
+P_EMA_FAST, P_EMA_SLOW, P_MACD_FAST, P_MACD_SLOW, P_MACD_SIG = 32, 33, 34, 35, 36
+P_RSI, P_BB, P_BB_STD, P_ATR, P_STO_K, P_STO_D, P_ADX = 37, 38, 39, 40, 41, 42, 43
+
+# Коэффициенты EMA 2/(n+1) считаются один раз в new_state, а не на каждом баре
+A_EMA_FAST, A_EMA_SLOW, A_MACD_FAST, A_MACD_SLOW, A_MACD_SIG = 44, 45, 46, 47, 48
+
+HEADER = 49  # дальше кольцевые буферы: bb, high, low, stoch_k, очереди max/min
+
+
+def new_state(ema_fast, ema_slow, macd_fast, macd_slow, macd_sig,
+              rsi_len, bb_len, bb_std, atr_len, sto_k, sto_d, adx_len):
+    st = np.full(HEADER + bb_len + 4 * sto_k + sto_d, np.nan)
+    st[N] = 0.0
+    for i in (AVG_GAIN, AVG_LOSS, TR_SUM, TR_S, PDM_S, MDM_S, DX_SUM, BB_MEAN, BB_M2,
+              MAXQ_H, MAXQ_C, MINQ_H, MINQ_C):
+        st[i] = 0.0
+    st[P_EMA_FAST:A_EMA_FAST] = (ema_fast, ema_slow, macd_fast, macd_slow, macd_sig,
+                             rsi_len, bb_len, bb_std, atr_len, sto_k, sto_d, adx_len)
+    st[A_EMA_FAST:HEADER] = [2.0 / (p + 1.0) for p in (ema_fast, ema_slow, macd_fast, macd_slow, macd_sig)]
+    return st
+
+
+@njit("f8(f8[::1], i8, i8, i8, i8, i8, i8, f8, f8)", cache=True)
+def _mono_push(st, q, h_slot, c_slot, vals, k, n, x, sign):
+    """
+    Монотонная очередь индексов (кольцо длины k в st[q:q+k]) для скользящего
+    max (sign=1) или min (sign=-1): каждый бар входит и выходит один раз.
+    Значение бара n уже должно лежать в st[vals + n % k]. Возвращает экстремум окна.
+    """
+    h = int(st[h_slot])
+    c = int(st[c_slot])
+    while c > 0 and st[q + h] <= n - k:
+        h = (h + 1) % k
+        c -= 1
+    while c > 0 and sign * st[vals + int(st[q + (h + c - 1) % k]) % k] <= sign * x:
+        c -= 1
+    st[q + (h + c) % k] = n
+    c += 1
+    st[h_slot] = h
+    st[c_slot] = c
+    return st[vals + int(st[q + h]) % k]
+
+
+# Явные сигнатуры: компиляция (или загрузка из кэша numba) происходит
+# при импорте, а не на первом цикле.
+# Без fastmath: NaN в состоянии означает «ещё не определено».
+@njit("void(f8[::1], f8, f8, f8)", cache=True)
+def _step(st, high, low, close):
+    n = int(st[N])
+    prev_close = st[PREV_C]
+    bb_len, sto_k, sto_d = int(st[P_BB]), int(st[P_STO_K]), int(st[P_STO_D])
+    rsi_len, atr_len, adx_len = int(st[P_RSI]), int(st[P_ATR]), int(st[P_ADX])
+    macd_slow = int(st[P_MACD_SLOW])
+
+    # EMA (как ewm(adjust=False): старт с первого значения)
+    if n == 0:
+        st[EMA20] = close
+        st[EMA50] = close
+        st[EMA_F] = close
+        st[EMA_S] = close
+        tr = high - low
+    else:
+        st[EMA20] += st[A_EMA_FAST] * (close - st[EMA20])
+        st[EMA50] += st[A_EMA_SLOW] * (close - st[EMA50])
+        st[EMA_F] += st[A_MACD_FAST] * (close - st[EMA_F])
+        st[EMA_S] += st[A_MACD_SLOW] * (close - st[EMA_S])
+        tr = max(high - low, abs(high - prev_close), abs(low - prev_close))
+
+    # MACD: сигнальная EMA стартует с первого полного значения медленной EMA
+    if n >= macd_slow - 1:
+        st[MACD] = st[EMA_F] - st[EMA_S]
+        if n == macd_slow - 1:
+            st[MACD_SIG] = st[MACD]
+        else:
+            st[MACD_SIG] += st[A_MACD_SIG] * (st[MACD] - st[MACD_SIG])
+        st[MACD_HIST] = st[MACD] - st[MACD_SIG]
+
+    # RSI (Уайлдер: первое среднее — SMA за rsi_len изменений, далее рекуррентно)
+    if n > 0:
+        delta = close - prev_close
+        gain = max(delta, 0.0)
+        loss = max(-delta, 0.0)
+        if n <= rsi_len:
+            st[AVG_GAIN] += gain / rsi_len
+            st[AVG_LOSS] += loss / rsi_len
+        else:
+            st[AVG_GAIN] = (st[AVG_GAIN] * (rsi_len - 1) + gain) / rsi_len
+            st[AVG_LOSS] = (st[AVG_LOSS] * (rsi_len - 1) + loss) / rsi_len
+        if n >= rsi_len:
+            if st[AVG_LOSS] == 0.0:
+                st[RSI] = 100.0
+            else:
+                st[RSI] = 100.0 - 100.0 / (1.0 + st[AVG_GAIN] / st[AVG_LOSS])
+
+    # Bollinger: скользящий Уэлфорд — O(1) на бар вместо пересчёта окна
+    bb = HEADER
+    slot = bb + n % bb_len
+    mean = st[BB_MEAN]
+    if n < bb_len:
+        d = close - mean
+        mean += d / (n + 1)
+        st[BB_M2] += d * (close - mean)
+    else:
+        old = st[slot]
+        mean_old = mean
+        mean += (close - old) / bb_len
+        st[BB_M2] += (close - old) * (close - mean + old - mean_old)
+    st[BB_MEAN] = mean
+    st[slot] = close
+    if n >= bb_len - 1:
+        std = math.sqrt(max(st[BB_M2] / bb_len, 0.0))
+        st[BB_HIGH] = mean + st[P_BB_STD] * std
+        st[BB_LOW] = mean - st[P_BB_STD] * std
+
+    # ATR: первое значение — среднее TR, далее Уайлдер
+    if n < atr_len:
+        st[TR_SUM] += tr
+        if n == atr_len - 1:
+            st[ATR] = st[TR_SUM] / atr_len
+    else:
+        st[ATR] = (st[ATR] * (atr_len - 1) + tr) / atr_len
+
+    # Stochastic: max/min окна через монотонные очереди, амортизированно O(1)
+    hi = bb + bb_len
+    lo = hi + sto_k
+    kb = lo + sto_k
+    qmax = kb + sto_d
+    qmin = qmax + sto_k
+    st[hi + n % sto_k] = high
+    st[lo + n % sto_k] = low
+    hh = _mono_push(st, qmax, MAXQ_H, MAXQ_C, hi, sto_k, n, high, 1.0)
+    ll = _mono_push(st, qmin, MINQ_H, MINQ_C, lo, sto_k, n, low, -1.0)
+    if n >= sto_k - 1:
+        st[STOCH_K] = 100.0 * (close - ll) / (hh - ll) if hh > ll else 50.0
+        m = n - (sto_k - 1)
+        st[kb + m % sto_d] = st[STOCH_K]
+        if m >= sto_d - 1:
+            s = 0.0
+            for j in range(kb, kb + sto_d):
+                s += st[j]
+            st[STOCH_D] = s / sto_d
+
+    # ADX (Уайлдер)
+    if n > 0:
+        up = high - st[PREV_H]
+        dn = st[PREV_L] - low
+        pdm = up if up > dn and up > 0.0 else 0.0
+        mdm = dn if dn > up and dn > 0.0 else 0.0
+        if n <= adx_len:
+            st[TR_S] += tr
+            st[PDM_S] += pdm
+            st[MDM_S] += mdm
+        else:
+            st[TR_S] += tr - st[TR_S] / adx_len
+            st[PDM_S] += pdm - st[PDM_S] / adx_len
+            st[MDM_S] += mdm - st[MDM_S] / adx_len
+        if n >= adx_len:
+            pdi = 100.0 * st[PDM_S] / st[TR_S] if st[TR_S] != 0.0 else 0.0
+            mdi = 100.0 * st[MDM_S] / st[TR_S] if st[TR_S] != 0.0 else 0.0
+            dx = 100.0 * abs(pdi - mdi) / (pdi + mdi) if pdi + mdi != 0.0 else 0.0
+            k = n - adx_len
+            if k < adx_len:
+                st[DX_SUM] += dx
+                if k == adx_len - 1:
+                    st[ADX] = st[DX_SUM] / adx_len
+            else:
+                st[ADX] = (st[ADX] * (adx_len - 1) + dx) / adx_len
+
+    st[CLOSE] = close
+    st[PREV_H] = high
+    st[PREV_L] = low
+    st[PREV_C] = close
+    st[N] = n + 1
+
+
+@njit(_UPDATE_SIG, cache=True)
+def ind_update(st, high, low, close):
+    """Прогоняет бары через состояние st (in-place) одним слитым циклом."""
+    for i in range(close.shape[0]):
+        _step(st, high[i], low[i], close[i])
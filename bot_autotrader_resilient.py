@@ -1,23 +1,38 @@
 import os
 import time
 import json
+import html
 import math
+import random
 import asyncio
+import pickle
+import tempfile
 import logging
+import aiohttp
 import requests
 import numpy as np
 import pandas as pd
-import yfinance as yf
 
-from ta.momentum import RSIIndicator, StochasticOscillator
-from ta.trend import EMAIndicator, MACD, ADXIndicator
-from ta.volatility import BollingerBands, AverageTrueRange
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import _kernels as K
+
+try:  # orjson быстрее json на каждом ответе Capital/Yahoo, но необязателен
+    import orjson
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
 
 # ==========================
 # НАСТРОЙКИ
 # ==========================
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
+TG_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
 
 CAPITAL_API_KEY = os.getenv("CAPITAL_API_KEY", "")
 CAPITAL_USERNAME = os.getenv("CAPITAL_USERNAME", "")
@@ -32,10 +47,23 @@ EPIC_BRENT = os.getenv("EPIC_BRENT", "OIL_BRENT")
 YF_GOLD = os.getenv("YF_GOLD", "GC=F")
 YF_BRENT = os.getenv("YF_BRENT", "BZ=F")
 
+# Инструменты: имя -> EPIC Capital и тикер Yahoo
+SYMBOLS = {
+    "GOLD": {"epic": EPIC_GOLD, "yf": YF_GOLD},
+    "BRENT": {"epic": EPIC_BRENT, "yf": YF_BRENT},
+}
+YF_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{ticker}"
+FETCH_RETRIES = 3
+# Полная загрузка: 7 дней (предел Yahoo для 1m — 8 дней на запрос)
+FULL_PERIOD = "7d"
+FULL_PERIOD_AGE = pd.Timedelta(days=7)
+FETCH_BACKOFF = 0.5  # сек, удваивается с каждой попыткой (+ случайный сдвиг)
+
 # Торговые параметры
 LEVERAGE = float(os.getenv("LEVERAGE", "20"))
 RISK_BALANCE_FRACTION = float(os.getenv("RISK_BALANCE_FRACTION", "0.25"))
 MAX_CONCURRENT_POS = int(os.getenv("MAX_CONCURRENT_POS", "2"))
+EXPOSURE_MULT = RISK_BALANCE_FRACTION * LEVERAGE  # доля баланса в позиции с учётом плеча
 
 # Индикаторы
 EMA_FAST, EMA_SLOW = 20, 50
@@ -46,191 +74,529 @@ ATR_LEN = 14
 STO_K, STO_D, STO_SMOOTH = 14, 3, 3
 ADX_LEN = 14
 
+# Сколько баров нужно, чтобы все индикаторы были определены
+WARMUP_BARS = max(EMA_SLOW, MACD_SLOW + MACD_SIG, 2 * ADX_LEN, BB_LEN, ATR_LEN, STO_K + STO_D)
+IND_SLOTS = {
+    "close": K.CLOSE, "ema20": K.EMA20, "ema50": K.EMA50, "rsi": K.RSI,
+    "macd": K.MACD, "macd_sig": K.MACD_SIG, "macd_hist": K.MACD_HIST,
+    "bb_high": K.BB_HIGH, "bb_low": K.BB_LOW, "atr": K.ATR,
+    "stoch_k": K.STOCH_K, "stoch_d": K.STOCH_D, "adx": K.ADX,
+}
+
 # ATR SL/TP
 SL_ATR_MULT, TP_ATR_MULT = 1.8, 1.2
+DIRECTION_SIGN = {"BUY": 1.0, "SELL": -1.0}
 
 # Интервал и цикл
 BAR_INTERVAL = os.getenv("BAR_INTERVAL", "1m")
 LOOKBACK_BARS = 600
-SLEEP_SECONDS = 30
+SLEEP_SECONDS = int(os.getenv("SLEEP_SECONDS", "30"))
+BAR_CLOSE_DELAY = 5  # сек после закрытия бара, чтобы Yahoo успел его отдать
+_UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400}
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 log = logging.getLogger("TraderKing")
 
 TOKENS = {"CST": "", "X-SECURITY-TOKEN": ""}
+# Токены Capital переживают рестарт: без лишнего логина при каждом старте
+TOKEN_FILE = os.getenv("TOKEN_FILE", "capital_tokens.json")
+# Сессия Capital живёт 10 минут без запросов — пингуем чаще
+SESSION_PING_SECONDS = 9 * 60
+
+# Пул HTTP-соединений: keep-alive вместо нового TLS на каждый запрос.
+# Retry повторяет только идемпотентные методы (POST ордера не дублируется).
+HTTP_TIMEOUT = (3, 10)
+
+def pooled_session(pool_maxsize):
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                          raise_on_status=False),
+    ))
+    return s
+
+# Отдельные сессии: постоянные заголовки Capital (с API-ключом) не уходят в Telegram
+SESSION = pooled_session(16)
+SESSION.headers.update({
+    "X-CAP-API-KEY": CAPITAL_API_KEY,
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+})
+TG_SESSION = pooled_session(4)
+# Очередь Telegram создаётся в main(); до этого tg() отправляет сразу
+TG_QUEUE = None
+TG_LOOP = None
+TG_BATCH = 10
+TG_MIN_INTERVAL = 1.0
+TG_MAX_LEN = 4096  # предел длины sendMessage
+# Повторная одинаковая ошибка уходит в Telegram не чаще раза в ERROR_COOLDOWN секунд
+ERROR_COOLDOWN = 600
+LAST_ERROR = {}  # ключ -> (текст, время отправки)
+LAST_SIGNAL = {k: None for k in SYMBOLS}
+# Баланс счёта между циклами (см. capital_balance)
+BALANCE_TTL = 60
+BALANCE_CACHE = {"ts": 0.0, "value": None}
+# Потоки для блокирующих вызовов requests (asyncio.to_thread): по паре на
+# инструмент и запас под Telegram/пинг, не больше пула соединений SESSION
+IO_WORKERS = 8
+
+# Состояние индикаторов между циклами (переживает рестарт через pickle)
+STATE_FILE = os.getenv("STATE_FILE", "indicator_state.pkl")
+STATE = {}  # ticker -> {"st": состояние индикаторов, "last_ts": время последнего закрытого бара}
+SCRATCH = {}  # ticker -> буфер состояния для формирующегося бара (не сохраняется)
+
+# Кэш OHLC: в памяти и в parquet, чтобы не качать 7 дней каждый цикл
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+BAR_CACHE = {}  # ticker -> DataFrame
 
 # ==========================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ==========================
 
-def tg(msg):
-    if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-        return
+def tg_send(msg):
+    """True, если Telegram принял сообщение."""
     try:
-        requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-            json={"chat_id": TELEGRAM_CHAT_ID, "text": msg, "parse_mode": "HTML"},
-            timeout=10,
+        r = TG_SESSION.post(
+            TG_URL,
+            data=json_dumps({"chat_id": TELEGRAM_CHAT_ID, "text": msg, "parse_mode": "HTML"}),
+            headers={"Content-Type": "application/json"},
+            timeout=HTTP_TIMEOUT,
         )
+        return r.status_code == 200
     except:
-        pass
+        return False
+
+def tg(msg):
+    """
+    Не ждёт Telegram: после старта цикла сообщение кладётся в очередь,
+    которую разбирает tg_worker. Можно вызывать и из потоков to_thread.
+    """
+    if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
+        return
+    if TG_QUEUE is None:
+        tg_send(msg)
+    else:
+        TG_LOOP.call_soon_threadsafe(TG_QUEUE.put_nowait, msg)
+
+async def tg_worker():
+    """
+    Отправляет накопившиеся сообщения одним постом (до TG_BATCH штук и не
+    длиннее TG_MAX_LEN). Если Telegram отклонил пачку, сообщения уходят
+    по одному — одно битое сообщение не теряет остальные.
+    """
+    pending = []
+    while True:
+        if not pending:
+            pending.append(await TG_QUEUE.get())
+        while not TG_QUEUE.empty():
+            pending.append(TG_QUEUE.get_nowait())
+        batch, size = [], 0
+        while pending and len(batch) < TG_BATCH and size + len(pending[0]) <= TG_MAX_LEN:
+            size += len(pending[0]) + 2  # + разделитель "\n\n"
+            batch.append(pending.pop(0))
+        if not batch:  # одно сообщение длиннее лимита
+            batch.append(pending.pop(0)[:TG_MAX_LEN])
+        if not await asyncio.to_thread(tg_send, "\n\n".join(batch)) and len(batch) > 1:
+            for msg in batch:
+                await asyncio.sleep(TG_MIN_INTERVAL)
+                await asyncio.to_thread(tg_send, msg)
+        # лимит Telegram ~1 сообщение/с на чат; пришедшее за паузу уйдёт одним постом
+        await asyncio.sleep(TG_MIN_INTERVAL)
+
+def tg_escape(e, limit=1000):
+    """Текст исключения для HTML-сообщения: экранирован и обрезан (тело 5xx бывает целой страницей)."""
+    return html.escape(str(e)[:limit])
+
+def tg_error(key, msg):
+    """tg() для ошибок: та же ошибка подряд не спамит чат."""
+    prev = LAST_ERROR.get(key)
+    now = time.monotonic()
+    if prev and prev[0] == msg and now - prev[1] < ERROR_COOLDOWN:
+        return
+    LAST_ERROR[key] = (msg, now)
+    tg(msg)
 
 def capital_headers():
-    return {
-        "X-CAP-API-KEY": CAPITAL_API_KEY,
-        "CST": TOKENS["CST"],
-        "X-SECURITY-TOKEN": TOKENS["X-SECURITY-TOKEN"],
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
+    # API-ключ и Accept/Content-Type уже стоят в SESSION.headers, а TOKENS
+    # меняется на месте при логине — отдаём его как есть, без копии
+    return TOKENS
 
 def capital_login():
     url = f"{CAPITAL_BASE_URL}/api/v1/session"
     data = {"identifier": CAPITAL_USERNAME, "password": CAPITAL_API_PASSWORD}
-    headers = {
-        "X-CAP-API-KEY": CAPITAL_API_KEY,
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-    r = requests.post(url, headers=headers, json=data, timeout=20)
+    r = SESSION.post(url, data=json_dumps(data), timeout=(3, 20))
     if r.status_code != 200:
         raise Exception(f"Login error: {r.text}")
     TOKENS["CST"] = r.headers.get("CST", "")
     TOKENS["X-SECURITY-TOKEN"] = r.headers.get("X-SECURITY-TOKEN", "")
+    save_tokens()
     tg("✅ <b>Capital авторизация успешна</b>")
     log.info("Login OK")
 
-def capital_get_account():
-    r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/accounts", headers=capital_headers(), timeout=15)
+def load_tokens():
+    """Токены с прошлого запуска; True, если оба на месте."""
+    try:
+        with open(TOKEN_FILE) as f:
+            saved = json.load(f)
+        TOKENS.update({k: saved.get(k, "") for k in TOKENS})
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning("Не удалось загрузить %s: %s", TOKEN_FILE, e)
+    return all(TOKENS.values())
+
+def save_tokens():
+    # mkstemp: права 0600 (токены — действующие учётные данные) и уникальное
+    # имя, т.к. capital_login может одновременно идти в двух потоках to_thread
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(TOKEN_FILE)), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(TOKENS, f)
+        os.replace(tmp, TOKEN_FILE)
+    except Exception as e:
+        log.warning("Не удалось сохранить %s: %s", TOKEN_FILE, e)
+        if tmp and os.path.exists(tmp):
+            os.remove(tmp)
+
+def capital_request(method, path, **kwargs):
+    """Запрос к Capital с одним перелогином при 401."""
+    url = f"{CAPITAL_BASE_URL}/api/v1/{path}"
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    r = SESSION.request(method, url, headers=capital_headers(), **kwargs)
     if r.status_code == 401:
         capital_login()
-        r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/accounts", headers=capital_headers(), timeout=15)
-    return r.json()
+        r = SESSION.request(method, url, headers=capital_headers(), **kwargs)
+    return r
+
+def capital_json(r):
+    """Тело ответа Capital; пустое (например, при 5xx от прокси) — как {}."""
+    return json_loads(r.content) if r.content else {}
+
+def capital_ping():
+    """Продлевает сессию Capital (при истёкшей — перелогин внутри capital_request)."""
+    capital_request("GET", "ping")
+
+async def session_keepalive():
+    while True:
+        await asyncio.sleep(SESSION_PING_SECONDS)
+        try:
+            await asyncio.to_thread(capital_ping)
+        except Exception as e:
+            log.warning("Пинг сессии Capital не прошёл: %s", e)
+
+def capital_get_account():
+    return capital_json(capital_request("GET", "accounts"))
+
+def capital_balance():
+    """
+    Доступный баланс с кэшем на BALANCE_TTL секунд: между сделками он почти
+    не меняется. После ордера кэш устаревает (ts = -inf).
+    """
+    now = time.monotonic()
+    if BALANCE_CACHE["value"] is not None and now - BALANCE_CACHE["ts"] <= BALANCE_TTL:
+        return BALANCE_CACHE["value"]
+    r = capital_request("GET", "accounts")
+    accounts = capital_json(r).get("accounts") if r.status_code == 200 else None
+    available = accounts[0].get("balance", {}).get("available") if accounts else None
+    if available is None:
+        # ошибку не кэшируем: берём прошлый баланс, а без него ордер пропускается
+        if BALANCE_CACHE["value"] is None:
+            raise Exception(f"Не удалось получить баланс: {r.status_code}")
+        log.warning("Баланс не получен (%s), используем прошлый", r.status_code)
+        return BALANCE_CACHE["value"]
+    BALANCE_CACHE["value"] = float(available)
+    BALANCE_CACHE["ts"] = now
+    return BALANCE_CACHE["value"]
 
 def capital_market_details(epic):
-    r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/markets/{epic}", headers=capital_headers(), timeout=15)
-    if r.status_code == 401:
-        capital_login()
-        r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/markets/{epic}", headers=capital_headers(), timeout=15)
-    return r.json()
+    return capital_json(capital_request("GET", f"markets/{epic}"))
 
 def capital_current_price(epic):
-    r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/markets/{epic}", headers=capital_headers(), timeout=15)
-    if r.status_code == 401:
-        capital_login()
-        r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/markets/{epic}", headers=capital_headers(), timeout=15)
-    snap = r.json().get("snapshot", {})
+    snap = capital_market_details(epic).get("snapshot", {})
     bid, offer = float(snap.get("bid", "nan")), float(snap.get("offer", "nan"))
     return (bid + offer) / 2 if not np.isnan(bid) and not np.isnan(offer) else np.nan
 
 def capital_open_positions():
-    r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/positions", headers=capital_headers(), timeout=15)
-    if r.status_code == 401:
-        capital_login()
-        r = requests.get(f"{CAPITAL_BASE_URL}/api/v1/positions", headers=capital_headers(), timeout=15)
-    return r.json().get("positions", [])
+    return capital_json(capital_request("GET", "positions")).get("positions", [])
+
+# Неизменная часть рыночного ордера
+ORDER_BASE = {"orderType": "MARKET", "forceOpen": True, "guaranteedStop": False}
 
 def capital_open_market(epic, direction, size, sl, tp):
     payload = {
+        **ORDER_BASE,
         "epic": epic,
         "direction": direction,
         "size": str(size),
-        "orderType": "MARKET",
-        "forceOpen": True,
-        "guaranteedStop": False,
         "stopLevel": float(sl),
         "limitLevel": float(tp),
     }
-    r = requests.post(f"{CAPITAL_BASE_URL}/api/v1/positions", headers=capital_headers(), data=json.dumps(payload))
-    if r.status_code == 401:
-        capital_login()
-        r = requests.post(f"{CAPITAL_BASE_URL}/api/v1/positions", headers=capital_headers(), data=json.dumps(payload))
+    r = capital_request("POST", "positions", data=json_dumps(payload))
     if r.status_code not in (200, 201):
         raise Exception(r.text)
-    return r.json()
-
-def fetch_bars(ticker):
-    df = yf.download(ticker, interval=BAR_INTERVAL, period="7d", auto_adjust=True, progress=False)
-    df = df.dropna().tail(LOOKBACK_BARS)
-    for c in ["Open", "High", "Low", "Close"]:
-        df[c] = pd.to_numeric(df[c], errors="coerce")
-    df = df.dropna()
-    return df
+    return capital_json(r)
+
+async def fetch_bars(session, ticker, period=FULL_PERIOD, start=None):
+    """OHLC с Yahoo v8/chart напрямую через aiohttp (не блокирует event loop)."""
+    url = YF_CHART_URL.format(ticker=ticker)
+    if start is not None:
+        params = {"interval": BAR_INTERVAL, "period1": int(start.timestamp()), "period2": int(time.time())}
+    else:
+        params = {"interval": BAR_INTERVAL, "range": period}
+    for attempt in range(1, FETCH_RETRIES + 1):
+        try:
+            async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=20)) as r:
+                r.raise_for_status()
+                data = await r.json(loads=json_loads)
+            break
+        except Exception as e:
+            # 4xx (кроме 429) повтором не лечится — сразу наверх
+            client_error = isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429
+            if attempt == FETCH_RETRIES or client_error:
+                raise
+            log.warning("%s: ошибка загрузки (%s), попытка %d/%d", ticker, e, attempt, FETCH_RETRIES)
+            await asyncio.sleep(FETCH_BACKOFF * 2 ** (attempt - 1) + random.random() * 0.1)
+    res = data["chart"]["result"][0]
+    quote = res["indicators"]["quote"][0]
+    # Котировки Yahoo и так имеют точность float32 — храним бары в нём (вдвое
+    # меньше памяти и parquet). Рекурсии индикаторов идут во float64 (_extract).
+    df = pd.DataFrame(
+        {c: quote.get(c.lower(), []) for c in ("Open", "High", "Low", "Close")},
+        index=pd.to_datetime(res.get("timestamp", []), unit="s", utc=True),
+        dtype=np.float32,
+    )
+    return df.dropna().tail(LOOKBACK_BARS)
 
-def compute_indicators(df):
-    close, high, low = df["Close"], df["High"], df["Low"]
-    ema20, ema50 = EMAIndicator(close, 20).ema_indicator(), EMAIndicator(close, 50).ema_indicator()
-    rsi = RSIIndicator(close, 14).rsi()
-    macd_i = MACD(close)
-    macd, macd_sig, macd_hist = macd_i.macd(), macd_i.macd_signal(), macd_i.macd_diff()
-    bb = BollingerBands(close)
-    bb_high, bb_low = bb.bollinger_hband(), bb.bollinger_lband()
-    atr = AverageTrueRange(high, low, close).average_true_range()
-    sto = StochasticOscillator(high, low, close)
-    stoch_k, stoch_d = sto.stoch(), sto.stoch_signal()
-    adx = ADXIndicator(high, low, close).adx()
-    df = pd.DataFrame({
-        "close": close,
-        "ema20": ema20,
-        "ema50": ema50,
-        "rsi": rsi,
-        "macd": macd,
-        "macd_sig": macd_sig,
-        "macd_hist": macd_hist,
-        "bb_high": bb_high,
-        "bb_low": bb_low,
-        "atr": atr,
-        "stoch_k": stoch_k,
-        "stoch_d": stoch_d,
-        "adx": adx,
-    }).dropna()
+def bar_cache_path(ticker):
+    return os.path.join(CACHE_DIR, f"{ticker}.parquet")
+
+async def get_bars(session, ticker):
+    """
+    Бары из кэша + только новые с Yahoo.
+    Полная история (FULL_PERIOD) качается при пустом кэше, при хвосте кэша
+    старше FULL_PERIOD (например, после долгого простоя) и если Yahoo
+    отклонил дельта-запрос (4xx).
+    """
+    cached = BAR_CACHE.get(ticker)
+    if cached is None and os.path.exists(bar_cache_path(ticker)):
+        try:
+            cached = pd.read_parquet(bar_cache_path(ticker)).astype(np.float32, copy=False)
+        except Exception as e:
+            log.warning("%s: не удалось прочитать кэш баров: %s", ticker, e)
+    if cached is not None and not cached.empty and pd.Timestamp.now(tz="UTC") - cached.index[-1] > FULL_PERIOD_AGE:
+        log.info("%s: кэш баров старше %s, качаем заново", ticker, FULL_PERIOD)
+        cached = None
+    if cached is not None and not cached.empty:
+        try:
+            new = await fetch_bars(session, ticker, start=cached.index[-1])
+        except aiohttp.ClientResponseError as e:
+            if not 400 <= e.status < 500:
+                raise
+            log.warning("%s: Yahoo отклонил дельта-запрос (%s), качаем заново", ticker, e.status)
+            cached = None
+    if cached is None or cached.empty:
+        df = await fetch_bars(session, ticker, FULL_PERIOD)
+    else:
+        if new.empty:
+            BAR_CACHE[ticker] = cached
+            return cached
+        # свежие бары заменяют пересекающийся хвост кэша (срез вместо маски дублей)
+        keep = cached.iloc[:cached.index.searchsorted(new.index[0])]
+        df = pd.concat([keep, new])
+    df = df.tail(LOOKBACK_BARS)
+    BAR_CACHE[ticker] = df
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(bar_cache_path(ticker), compression="zstd")
+    except Exception as e:
+        log.warning("%s: не удалось сохранить кэш баров: %s", ticker, e)
     return df
 
+def ind_new():
+    """Пустое состояние индикаторов для одного инструмента."""
+    return K.new_state(EMA_FAST, EMA_SLOW, MACD_FAST, MACD_SLOW, MACD_SIG,
+                       RSI_LEN, BB_LEN, BB_STD, ATR_LEN, STO_K, STO_D, ADX_LEN)
+
+def ind_values(st):
+    return {k: float(st[i]) for k, i in IND_SLOTS.items()}
+
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return
+    try:
+        with open(STATE_FILE, "rb") as f:
+            saved = pickle.load(f)
+        # состояние другой раскладки или с другими периодами индикаторов
+        # (они хранятся в слотах P_*/A_*) пересчитается с нуля
+        fresh = ind_new()
+        params = fresh[K.P_EMA_FAST:K.HEADER]
+        STATE.update({t: e for t, e in saved.items()
+                      if isinstance(e.get("st"), np.ndarray) and len(e["st"]) == len(fresh)
+                      and np.array_equal(e["st"][K.P_EMA_FAST:K.HEADER], params)})
+        log.info("Состояние индикаторов загружено: %s", ", ".join(STATE))
+    except Exception as e:
+        log.warning("Не удалось загрузить %s: %s", STATE_FILE, e)
+
+def save_state():
+    try:
+        tmp = STATE_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(STATE, f)
+        os.replace(tmp, STATE_FILE)
+    except Exception as e:
+        log.warning("Не удалось сохранить %s: %s", STATE_FILE, e)
+
+def _extract(df):
+    """High/Low/Close как непрерывные float64-массивы."""
+    return tuple(np.ascontiguousarray(df[c].to_numpy(np.float64)) for c in ("High", "Low", "Close"))
+
+def update_indicators(ticker, df):
+    """
+    Досчитывает индикаторы только по новым закрытым барам.
+    Последний бар df может ещё формироваться, поэтому он не попадает
+    в сохранённое состояние, а считается поверх копии.
+    Возвращает (row_prev, row) или (None, None), если истории мало.
+    """
+    ts = df.index
+    last = len(ts) - 1  # индекс формирующегося бара
+    ent = STATE.get(ticker)
+    if ent is None or (last and ent["last_ts"] < ts[0]):
+        ent = {"st": ind_new(), "last_ts": None}
+        i0 = 0
+    else:
+        i0 = min(ts.searchsorted(ent["last_ts"], side="right"), last)
+    # из pandas берём только ещё не учтённые бары (обычно один-два), дальше numpy
+    high, low, close = _extract(df.iloc[i0:])
+    n = last - i0  # сколько из них закрыто
+    st = ent["st"]
+    if n:
+        K.ind_update(st, high[:n], low[:n], close[:n])
+        ent["last_ts"] = ts[last - 1]
+        STATE[ticker] = ent
+        save_state()
+    if st[K.N] < WARMUP_BARS:
+        return None, None
+    # формирующийся бар считаем в постоянном буфере тикера, без новой копии
+    cur = SCRATCH.get(ticker)
+    if cur is None or len(cur) != len(st):
+        cur = SCRATCH[ticker] = np.empty_like(st)
+    np.copyto(cur, st)
+    K.ind_update(cur, high[n:], low[n:], close[n:])
+    return ind_values(st), ind_values(cur)
+
 def signal(row_prev, row):
-    buy = row["ema20"] > row["ema50"] and row["macd"] > row["macd_sig"] and row["rsi"] > 55 and row["adx"] > 20
-    sell = row["ema20"] < row["ema50"] and row["macd"] < row["macd_sig"] and row["rsi"] < 45 and row["adx"] > 20
-    if buy and not sell:
+    # row — обычный dict из float: одна выборка на поле, без pandas-индексации.
+    # Условия BUY и SELL взаимоисключающие (ema20 > ema50 против ema20 < ema50).
+    ema20, ema50, macd, macd_sig, rsi, adx = (
+        row["ema20"], row["ema50"], row["macd"], row["macd_sig"], row["rsi"], row["adx"])
+    if not adx > 20:  # NaN тоже даёт HOLD
+        return "HOLD"
+    if ema20 > ema50 and macd > macd_sig and rsi > 55:
         return "BUY"
-    elif sell and not buy:
+    if ema20 < ema50 and macd < macd_sig and rsi < 45:
         return "SELL"
-    else:
-        return "HOLD"
+    return "HOLD"
 
-def trade(epic, ticker, name):
-    df = fetch_bars(ticker)
-    ind = compute_indicators(df)
-    if len(ind) < 5:
+def compute_tp_sl(price, direction, atr):
+    """SL/TP от уже посчитанного ATR (без повторного расчёта индикаторов)."""
+    sign = DIRECTION_SIGN[direction]
+    return price - sign * atr * SL_ATR_MULT, price + sign * atr * TP_ATR_MULT
+
+def bar_seconds(interval):
+    """'1m' -> 60, '1h' -> 3600; None для интервалов без фиксированной длины (1wk, 1mo)."""
+    num, unit = interval[:-1], interval[-1]
+    return int(num) * _UNIT_SECONDS[unit] if num.isdigit() and unit in _UNIT_SECONDS else None
+
+def next_sleep():
+    """
+    Не дольше SLEEP_SECONDS, но с пробуждением сразу после закрытия бара:
+    решение по закрытому бару не ждёт лишние полцикла.
+    """
+    bar = bar_seconds(BAR_INTERVAL)
+    if not bar:
+        return SLEEP_SECONDS
+    return min(SLEEP_SECONDS, bar - time.time() % bar + BAR_CLOSE_DELAY)
+
+def position_size(balance, price):
+    return max(0.1, round(balance * EXPOSURE_MULT / price, 2))
+
+async def fetch_all_bars(session):
+    """Бары всех инструментов одним шагом цикла (параллельно, одна aiohttp-сессия)."""
+    names = list(SYMBOLS)
+    frames = await asyncio.gather(*(get_bars(session, SYMBOLS[n]["yf"]) for n in names),
+                                  return_exceptions=True)
+    return dict(zip(names, frames))
+
+async def trade(name, meta, df):
+    epic, ticker = meta["epic"], meta["yf"]
+    if df.empty:
+        return
+    row_prev, row = update_indicators(ticker, df)
+    if row is None:
         return
-    row_prev, row = ind.iloc[-2], ind.iloc[-1]
     sig = signal(row_prev, row)
+    if sig != LAST_SIGNAL[name]:
+        log.info("%s: сигнал %s -> %s", name, LAST_SIGNAL[name], sig)
+        LAST_SIGNAL[name] = sig
     if sig == "HOLD":
         return
-    acc = capital_get_account()
-    balance = float(acc.get("accounts", [{}])[0].get("balance", {}).get("available", 0.0))
-    price = capital_current_price(epic)
-    atr = row["atr"]
-    sl = price - atr * SL_ATR_MULT if sig == "BUY" else price + atr * SL_ATR_MULT
-    tp = price + atr * TP_ATR_MULT if sig == "BUY" else price - atr * TP_ATR_MULT
-    size = max(0.1, round((balance * RISK_BALANCE_FRACTION * LEVERAGE) / price, 2))
+    # requests блокирующий — уводим в поток, чтобы не стопорить другие тикеры
+    balance, price = await asyncio.gather(
+        asyncio.to_thread(capital_balance),
+        asyncio.to_thread(capital_current_price, epic),
+    )
+    if np.isnan(price):
+        return
+    sl, tp = compute_tp_sl(price, sig, row["atr"])
+    size = position_size(balance, price)
     try:
-        resp = capital_open_market(epic, sig, size, sl, tp)
+        resp = await asyncio.to_thread(capital_open_market, epic, sig, size, sl, tp)
+        BALANCE_CACHE["ts"] = -math.inf  # маржа изменилась — перечитать баланс
         msg = f"✅ <b>{name}</b> {sig}\nЦена: {price:.2f}\nSL: {sl:.2f} | TP: {tp:.2f}\nRSI: {row['rsi']:.1f}"
         tg(msg)
-        log.info(f"{name}: {sig} исполнен {resp}")
+        log.info("%s: %s исполнен %s", name, sig, resp)
     except Exception as e:
-        tg(f"❌ {name}: ошибка {e}")
+        log.error("%s: ошибка ордера %s: %s", name, sig, e)
+        tg_error(name, f"❌ {name}: ошибка {tg_escape(e)}")
 
 async def main():
-    tg("🚀 <b>TraderKing LIVE запущен (GOLD + BRENT)</b>")
-    capital_login()
-    while True:
-        try:
-            trade(EPIC_GOLD, YF_GOLD, "GOLD")
-            trade(EPIC_BRENT, YF_BRENT, "BRENT")
-        except Exception as e:
-            tg(f"⚠️ Ошибка цикла: {e}")
-            log.exception(e)
-        time.sleep(SLEEP_SECONDS)
+    global TG_QUEUE, TG_LOOP
+    TG_LOOP = asyncio.get_running_loop()
+    TG_LOOP.set_default_executor(ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io"))
+    TG_QUEUE = asyncio.Queue()
+    tg_task = asyncio.create_task(tg_worker())
+    tg(f"🚀 <b>TraderKing LIVE запущен ({' + '.join(SYMBOLS)})</b>")
+    log.info("Индикаторы: %s", "numba" if K.JIT else "чистый Python (numba не установлена)")
+    load_state()
+    if load_tokens():
+        log.info("Токены Capital взяты из %s", TOKEN_FILE)
+    else:
+        await asyncio.to_thread(capital_login)
+    keepalive = asyncio.create_task(session_keepalive())
+    # DNS Yahoo кэшируется на 5 минут, соединения переиспользуются между циклами
+    connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(headers={"User-Agent": "Mozilla/5.0"}, connector=connector) as session:
+        while True:
+            frames = await fetch_all_bars(session)
+            ready = {n: df for n, df in frames.items() if not isinstance(df, Exception)}
+            results = dict(zip(ready, await asyncio.gather(
+                *(trade(n, SYMBOLS[n], df) for n, df in ready.items()),
+                return_exceptions=True,
+            )))
+            # итог по каждому инструменту: ошибка загрузки или ошибка торговли
+            for n, e in {**frames, **results}.items():
+                if isinstance(e, Exception):
+                    tg_error(n, f"⚠️ {n}: ошибка цикла: {tg_escape(e)}")
+                    log.error("%s: ошибка цикла", n, exc_info=e)
+            await asyncio.sleep(next_sleep())
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:  # uvloop быстрее стандартного цикла событий, но необязателен
+        import uvloop
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    run(main())